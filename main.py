@@ -1,208 +1,857 @@
-import os
-import io
-import time
-import re
-import openai
-from PIL import Image, ImageDraw, ImageFont
-from google.cloud import vision
-import arabic_reshaper
-from bidi.algorithm import get_display
-from dotenv import load_dotenv
-
-# === Setup ===
-BASE_DIR = os.path.dirname(__file__)
-load_dotenv()
-openai.api_key = os.getenv("OPENAIKEY")
-os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = os.path.join(BASE_DIR, "static-mile-460504-q5-253eccbdfafa.json")
-
-# === Translate with OpenL ===
-def translate_openl(text):
-    try:
-        response = openai.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "You're an expert Arabic manga translator. Translate English text into spoken Palestinian Shami Arabic with natural, emotionally expressive phrasing like you'd hear in a conversation or dubbed anime.\n\n"
-                        "✅ Follow these rules:\n"
-                        "- Use only Palestinian Levantine (no Modern Standard Arabic).\n"
-                        "- Avoid literal structure—translate ideas, not grammar.\n"
-                        "- Keep emotional tone, slang, and phrasing local to Palestinian speech.\n"
-                        "- Use connectors like: إنو، هاد، هيك، شو، ليش، بقلك، مهاجمينا، هالحكي، بكون، بدنا، الخ…\n"
-                        "- Masculine/feminine forms must match.\n"
-                        "- Preserve the original artist’s intent and emotional weight of the scene.\n"
-                        "- Add punctuation that reflects tone (!؟…) but **don’t add or invent** content.\n\n"
-                        "❌ Wrong: 'من كان يخبر الجميع أنهم يهاجموننا؟'\n"
-                        "✅ Right: 'مين قال للكل إنو كانوا مهاجمينا؟'\n\n"
-                        "Only return the Arabic translation."
-                    )
-                },
-                {"role": "user", "content": text}
-            ],
-            temperature=0.7,
-        )
-        return response.choices[0].message.content.strip()
-    except Exception as e:
-        print(f"Error translating '{text}': {e}")
-        return text
-
-# === Google OCR ===
-def google_ocr(image_path):
-    client = vision.ImageAnnotatorClient()
-    with io.open(image_path, "rb") as image_file:
-        content = image_file.read()
-    image = vision.Image(content=content)
-    response = client.document_text_detection(image=image)
-
-    if response.error.message:
-        raise Exception(f"Google OCR error: {response.error.message}")
-
-    sentence_boxes = []
-
-    for page in response.full_text_annotation.pages:
-        for block in page.blocks:
-            for paragraph in block.paragraphs:
-                sentence_text = ""
-                x_coords, y_coords = [], []
-
-                for word in paragraph.words:
-                    word_text = ''.join([symbol.text for symbol in word.symbols])
-                    sentence_text += word_text + " "
-                    for vertex in word.bounding_box.vertices:
-                        x_coords.append(vertex.x)
-                        y_coords.append(vertex.y)
-
-                clean_text = sentence_text.strip()
-                area = (max(x_coords) - min(x_coords)) * (max(y_coords) - min(y_coords))
-                if len(clean_text) <= 6 and area > 40000:
-                    continue
-                if not re.search(r'\w', clean_text):
-                    continue
-                bbox = [min(x_coords), min(y_coords), max(x_coords), max(y_coords)]
-                sentence_boxes.append({"text": clean_text, "bbox": bbox})
-
-    return sentence_boxes
-
-# === Wrap Arabic Text ===
-def wrap_text(text, draw, font, max_width):
-    words = text.split()
-    lines = []
-    current_line = ''
-    for word in words:
-        test_line = word if not current_line else f"{current_line} {word}"
-        width = draw.textbbox((0, 0), test_line, font=font)[2]
-        if width <= max_width:
-            current_line = test_line
-        else:
-            lines.append(current_line)
-            current_line = word
-    if current_line:
-        lines.append(current_line)
-    return lines
-
-# === Erase & Draw Text ===
-def erase_sentences_from_image(image_path, sentence_boxes, output_path):
-    invalid_phrases = [
-        "please provide the text", "cannot translate the text",
-        "doesn’t convey a clear meaning", "can’t assist with that",
-        "does not appear to be a coherent phrase",
-        "I'm sorry, but I can't assist with that.",
-    ]
-
-    image = Image.open(image_path).convert("RGB")
-    draw = ImageDraw.Draw(image)
-    font_path = os.path.join(BASE_DIR, "Noto_Naskh_Arabic", "NotoNaskhArabic-VariableFont_wght.ttf")
-    padding_x, padding_y = 12, 10
-
-    for box in sentence_boxes:
-        x0, y0, x1, y1 = box["bbox"]
-        x0 = max(0, x0 - padding_x)
-        y0 = max(0, y0 - padding_y)
-        x1 += padding_x
-        y1 += padding_y
-        draw.rectangle([(x0, y0), (x1, y1)], fill="white")
-
-    for box in sentence_boxes:
-        text = box["text"].strip()
-        if not text or text.isspace():
-            continue
-
-        x0, y0, x1, y1 = box["bbox"]
-        x0 = max(0, x0 - padding_x)
-        y0 = max(0, y0 - padding_y)
-        x1 += padding_x
-        y1 += padding_y
-        max_width = x1 - x0
-        max_height = y1 - y0
-        if max_width < 10 or max_height < 10:
-            continue
-
-        translated_text = translate_openl(text)
-        if any(p in translated_text.lower() for p in invalid_phrases):
-            print(f"Skipping invalid translation: {translated_text}")
-            continue
-        translated_text = re.sub(r'[A-Za-z]', '', translated_text).strip()
-        if not translated_text or translated_text.isspace():
-            print("Translation was empty after removing English.")
-            continue
-
-        font_size = 23
-        min_font_size = 18
-        chosen_font = None
-        wrapped_lines = []
-        reshaped_lines = []
-
-        while font_size >= min_font_size:
-            try:
-                font = ImageFont.truetype(font_path, font_size)
-            except:
-                font = ImageFont.load_default()
-
-            wrapped_lines = wrap_text(translated_text, draw, font, max_width)
-            reshaped_lines = [get_display(arabic_reshaper.reshape(line)) for line in wrapped_lines]
-
-            line_height = draw.textbbox((0, 0), "Test", font=font)[3]
-            total_height = line_height * len(reshaped_lines) + (len(reshaped_lines) - 1) * 4
-
-            if total_height <= max_height:
-                chosen_font = font
-                break
-            font_size -= 2
-
-        if not chosen_font:
-            font = ImageFont.truetype(font_path, min_font_size)
-            wrapped_lines = wrap_text(translated_text, draw, font, max_width)
-            reshaped_lines = [get_display(arabic_reshaper.reshape(line)) for line in wrapped_lines]
-            line_height = draw.textbbox((0, 0), "Test", font=font)[3]
-            total_height = line_height * len(reshaped_lines) + (len(reshaped_lines) - 1) * 4
-        else:
-            font = chosen_font
-
-        current_y = y0 + ((max_height - total_height) // 2)
-        for line in reshaped_lines:
-            line_width = draw.textbbox((0, 0), line, font=font)[2]
-            center_x = x0 + ((max_width - line_width) // 2)
-            draw.text((center_x, current_y), line, fill="black", font=font)
-            current_y += line_height + 4
-
-    image.save(output_path)
-    print(f"✅ Translated and saved: {output_path}")
-
-# === Batch Processor ===
-def process_folder(folder_path, output_folder):
-    supported_exts = [".jpg", ".jpeg", ".png", ".webp"]
-    os.makedirs(output_folder, exist_ok=True)
-
-    for filename in os.listdir(folder_path):
-        if any(filename.lower().endswith(ext) for ext in supported_exts):
-            input_path = os.path.join(folder_path, filename)
-            output_path = os.path.join(output_folder, f"translated_{filename}")
-            print(f"🔄 Processing: {filename}")
-            sentences = google_ocr(input_path)
-            erase_sentences_from_image(input_path, sentences, output_path)
-
-# === Run ===
-input_folder = os.path.join(BASE_DIR, "images")
-output_folder = os.path.join(BASE_DIR, "output")
-process_folder(input_folder, output_folder)
+import os
+import io
+import argparse
+import time
+import re
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import functools
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+import openai
+from openai import AsyncOpenAI
+from PIL import Image, ImageDraw, ImageFont
+from google.api_core import exceptions as google_exceptions
+from google.cloud import vision
+import tiktoken
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+import numpy as np
+import arabic_reshaper
+from bidi.algorithm import get_display
+from dotenv import load_dotenv
+
+# === Setup ===
+BASE_DIR = os.path.dirname(__file__)
+load_dotenv()
+os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = os.path.join(BASE_DIR, "static-mile-460504-q5-253eccbdfafa.json")
+TRANSLATE_CONCURRENCY = 8
+PAGE_WORKERS = 8
+PIPELINE_QUEUE_SIZE = 32
+OPENAI_RPM = 500
+OPENAI_TPM = 30000
+
+# === Retry ===
+def _is_transient(exc):
+    if isinstance(exc, (
+        openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError,
+        google_exceptions.ResourceExhausted, google_exceptions.ServiceUnavailable,
+        google_exceptions.DeadlineExceeded, _OCRImagesPending,
+    )):
+        return True
+    status = getattr(exc, "status_code", None) or getattr(exc, "code", None)
+    if status == 429 or (isinstance(status, int) and 500 <= status < 600):
+        return True
+    message = str(exc).lower()
+    return "rate limit" in message or "quota" in message
+
+retry_transient = retry(
+    retry=retry_if_exception(_is_transient),
+    wait=wait_random_exponential(min=1, max=30),
+    stop=stop_after_attempt(5),
+    reraise=True,
+)
+
+# === Rate Limit ===
+class AsyncRateLimiter:
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = requests_per_minute
+        self._tokens = tokens_per_minute
+        self._refilled_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._refilled_at
+        self._refilled_at = now
+        self._requests = min(self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60)
+        self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
+
+    async def acquire(self, tokens):
+        tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            with self._lock:
+                self._refill()
+                if self._requests >= 1 and self._tokens >= tokens:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    return
+                wait = max(
+                    (1 - self._requests) * 60 / self.requests_per_minute,
+                    (tokens - self._tokens) * 60 / self.tokens_per_minute,
+                )
+            await asyncio.sleep(wait)
+
+    def update_from_headers(self, headers):
+        remaining_requests = headers.get("x-ratelimit-remaining-requests")
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        with self._lock:
+            if remaining_requests is not None:
+                self._requests = min(self._requests, int(remaining_requests))
+            if remaining_tokens is not None:
+                self._tokens = min(self._tokens, int(remaining_tokens))
+
+rate_limiter = AsyncRateLimiter(OPENAI_RPM, OPENAI_TPM)
+
+# === OpenAI Client ===
+_openai_client = None
+
+def _get_openai_client():
+    # Built on first use so --help and argument errors work without OPENAIKEY set.
+    # Retries are handled by retry_transient alone, so the SDK's own are disabled.
+    global _openai_client
+    _openai_client = _openai_client or AsyncOpenAI(api_key=os.getenv("OPENAIKEY"), max_retries=0)
+    return _openai_client
+
+# === Translate with OpenL ===
+TRANSLATE_MODEL = "gpt-4o"
+# A bubble's translation is a sentence or two; the cap is what each call is charged for its reply.
+TRANSLATE_MAX_TOKENS = 300
+TRANSLATE_SYSTEM_PROMPT = (
+    "You're an expert Arabic manga translator. Translate English text into spoken Palestinian Shami Arabic with natural, emotionally expressive phrasing like you'd hear in a conversation or dubbed anime.\n\n"
+    "✅ Follow these rules:\n"
+    "- Use only Palestinian Levantine (no Modern Standard Arabic).\n"
+    "- Avoid literal structure—translate ideas, not grammar.\n"
+    "- Keep emotional tone, slang, and phrasing local to Palestinian speech.\n"
+    "- Use connectors like: إنو، هاد، هيك، شو، ليش، بقلك، مهاجمينا، هالحكي، بكون، بدنا، الخ…\n"
+    "- Masculine/feminine forms must match.\n"
+    "- Preserve the original artist’s intent and emotional weight of the scene.\n"
+    "- Add punctuation that reflects tone (!؟…) but **don’t add or invent** content.\n\n"
+    "❌ Wrong: 'من كان يخبر الجميع أنهم يهاجموننا؟'\n"
+    "✅ Right: 'مين قال للكل إنو كانوا مهاجمينا؟'\n\n"
+    "Only return the Arabic translation."
+)
+
+INVALID_PHRASES = [
+    "please provide the text", "cannot translate the text",
+    "doesn’t convey a clear meaning", "can’t assist with that",
+    "does not appear to be a coherent phrase",
+    "I'm sorry, but I can't assist with that.",
+]
+_INVALID_RE = re.compile('|'.join(map(re.escape, INVALID_PHRASES)), re.I)
+_LATIN_RE = re.compile(r'[A-Za-z]+')
+
+def _usable_translation(translated_text):
+    # Refusals and all-English replies leave an erased bubble blank, so they are
+    # neither drawn nor cached (a cached one would blank that bubble on every rerun).
+    return not _INVALID_RE.search(translated_text) and bool(_LATIN_RE.sub('', translated_text).strip())
+
+translation_cache = sqlite3.connect(os.path.join(BASE_DIR, "tcache.db"), check_same_thread=False)
+translation_cache.execute("CREATE TABLE IF NOT EXISTS t(k TEXT PRIMARY KEY, v TEXT)")
+_translation_memo = {}
+
+def _translation_key(text):
+    return hashlib.sha256((TRANSLATE_MODEL + TRANSLATE_SYSTEM_PROMPT + text).encode()).hexdigest()
+
+def _chat_request(text):
+    return {
+        "model": TRANSLATE_MODEL,
+        "messages": [
+            {"role": "system", "content": TRANSLATE_SYSTEM_PROMPT},
+            {"role": "user", "content": text}
+        ],
+        "temperature": 0.7,
+        "max_tokens": TRANSLATE_MAX_TOKENS,
+    }
+
+def _cached_translation(text):
+    key = _translation_key(text)
+    if key in _translation_memo:
+        return _translation_memo[key]
+    row = translation_cache.execute("SELECT v FROM t WHERE k=?", (key,)).fetchone()
+    if row:
+        _translation_memo[key] = row[0]
+        return row[0]
+    return None
+
+def _store_translation(text, translated_text):
+    if not _usable_translation(translated_text):
+        return
+    key = _translation_key(text)
+    _translation_memo[key] = translated_text
+    translation_cache.execute("INSERT OR REPLACE INTO t(k, v) VALUES (?, ?)", (key, translated_text))
+
+@functools.lru_cache(maxsize=None)
+def _encoding():
+    # Loaded on first use: tiktoken may download the encoding, which batch runs never need.
+    try:
+        return tiktoken.encoding_for_model(TRANSLATE_MODEL)
+    except Exception as e:
+        print(f"⚠️ Could not load the tiktoken encoding, estimating tokens from length: {e}")
+        return None
+
+def _count_tokens(text):
+    encoding = _encoding()
+    if encoding is None:
+        return len(text) // 2 + 1
+    return len(encoding.encode(text))
+
+@functools.lru_cache(maxsize=None)
+def _system_prompt_tokens():
+    return _count_tokens(TRANSLATE_SYSTEM_PROMPT)
+
+@retry_transient
+async def _chat_completion(text):
+    # OpenAI counts max_tokens toward TPM up front, so the bucket is charged for it too.
+    await rate_limiter.acquire(_system_prompt_tokens() + _count_tokens(text) + TRANSLATE_MAX_TOKENS)
+    raw_response = await _get_openai_client().chat.completions.with_raw_response.create(**_chat_request(text))
+    rate_limiter.update_from_headers(raw_response.headers)
+    return raw_response.parse()
+
+async def translate_openl(text):
+    cached = _cached_translation(text)
+    if cached is not None:
+        return cached
+
+    try:
+        response = await _chat_completion(text)
+        translated_text = response.choices[0].message.content.strip()
+    except Exception as e:
+        print(f"Error translating '{text}': {e}")
+        return text
+
+    _store_translation(text, translated_text)
+    return translated_text
+
+# All translations run on one background event loop so every page worker shares
+# the same AsyncOpenAI connection pool, semaphore and SQLite connection.
+_translate_loop = asyncio.new_event_loop()
+threading.Thread(target=_translate_loop.run_forever, daemon=True).start()
+_translate_semaphore = asyncio.Semaphore(TRANSLATE_CONCURRENCY)
+_inflight_translations = {}
+
+async def _translate_limited(text):
+    async with _translate_semaphore:
+        return await translate_openl(text)
+
+def _translate_shared(text):
+    # Pages translating the same text at the same time share one request.
+    task = _inflight_translations.get(text)
+    if task is None:
+        task = asyncio.ensure_future(_translate_limited(text))
+        _inflight_translations[text] = task
+        task.add_done_callback(lambda _: _inflight_translations.pop(text, None))
+    return asyncio.shield(task)
+
+async def _translate_all(texts):
+    unique_texts = list(dict.fromkeys(texts))
+    translated = await asyncio.gather(*(_translate_shared(text) for text in unique_texts))
+    translation_cache.commit()
+    translation_by_text = dict(zip(unique_texts, translated))
+    return [translation_by_text[text] for text in texts]
+
+def translate_texts(texts):
+    return asyncio.run_coroutine_threadsafe(_translate_all(texts), _translate_loop).result()
+
+# === OpenAI Batch ===
+BATCH_POLL_SECONDS = 30
+BATCH_DONE_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+# Submitted batch ids live next to the translation cache, so a crash or Ctrl-C while
+# polling resumes the already-paid-for batch on the next run instead of resubmitting.
+translation_cache.execute("CREATE TABLE IF NOT EXISTS batches(id TEXT PRIMARY KEY, texts TEXT)")
+translation_cache.commit()
+
+@retry_transient
+async def _upload_batch_file(payload):
+    return await _get_openai_client().files.create(file=("translations.jsonl", payload), purpose="batch")
+
+async def _find_batch(input_file_id):
+    # Batches are listed newest first, and ours was created moments ago.
+    page = await _get_openai_client().batches.list(limit=100)
+    return next((batch for batch in page.data if batch.input_file_id == input_file_id), None)
+
+@retry_transient
+async def _create_batch(input_file_id):
+    # Each retry is a fresh POST, so a create that timed out after OpenAI accepted it
+    # would start a second billed batch that no saved row ever collects; reuse it instead.
+    existing = await _find_batch(input_file_id)
+    if existing is not None:
+        return existing
+    return await _get_openai_client().batches.create(
+        input_file_id=input_file_id, endpoint="/v1/chat/completions", completion_window="24h",
+        extra_headers={"Idempotency-Key": f"batch-{input_file_id}"},
+    )
+
+@retry_transient
+async def _retrieve_batch(batch_id):
+    return await _get_openai_client().batches.retrieve(batch_id)
+
+@retry_transient
+async def _download_file(file_id):
+    return (await _get_openai_client().files.content(file_id)).text
+
+def _batch_result_text(result):
+    response = result.get("response") or {}
+    if response.get("status_code") != 200:
+        return None
+    choices = (response.get("body") or {}).get("choices") or [{}]
+    content = (choices[0].get("message") or {}).get("content")
+    return content.strip() if content else None
+
+def _forget_batch(batch_id):
+    translation_cache.execute("DELETE FROM batches WHERE id=?", (batch_id,))
+    translation_cache.commit()
+
+async def _collect_batch(batch, texts_by_id):
+    print(f"📦 Batch {batch.id} finished: {batch.status}")
+    translations = {}
+    if batch.output_file_id:
+        for line in (await _download_file(batch.output_file_id)).splitlines():
+            result = json.loads(line)
+            custom_id = result.get("custom_id")
+            translated_text = _batch_result_text(result)
+            if custom_id not in texts_by_id or translated_text is None:
+                continue
+            translations[custom_id] = translated_text
+            _store_translation(texts_by_id[custom_id], translated_text)
+    _forget_batch(batch.id)
+    return translations
+
+async def _finish_batch(batch_id, texts_by_id):
+    batch = await _retrieve_batch(batch_id)
+    while batch.status not in BATCH_DONE_STATUSES:
+        await asyncio.sleep(BATCH_POLL_SECONDS)
+        batch = await _retrieve_batch(batch_id)
+    return await _collect_batch(batch, texts_by_id)
+
+async def _resume_batch(batch_id, texts_by_id, wait):
+    # Returns False only when the batch is still running and wait is off.
+    try:
+        batch = await _retrieve_batch(batch_id)
+        if batch.status not in BATCH_DONE_STATUSES:
+            if not wait:
+                return False
+            await _finish_batch(batch_id, texts_by_id)
+        else:
+            await _collect_batch(batch, texts_by_id)
+    except openai.NotFoundError as e:
+        # A saved batch that is gone (batch or its output deleted) must not block every
+        # later run; its texts are uncached and simply get resubmitted. Any other error
+        # (bad key, no permission) propagates and keeps the row for the next run.
+        print(f"⚠️ Dropping saved batch {batch_id}, it can no longer be resumed: {e}")
+        _forget_batch(batch_id)
+    return True
+
+async def harvest_batches():
+    running = {}
+    for batch_id, texts in translation_cache.execute("SELECT id, texts FROM batches").fetchall():
+        texts_by_id = json.loads(texts)
+        if not await _resume_batch(batch_id, texts_by_id, wait=False):
+            running[batch_id] = texts_by_id
+    return running
+
+async def wait_for_batches(batches):
+    for batch_id, texts_by_id in batches.items():
+        print(f"📦 Waiting for saved OpenAI batch {batch_id}")
+        await _resume_batch(batch_id, texts_by_id, wait=True)
+
+async def translate_batch(texts_by_id):
+    payload = "\n".join(
+        json.dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": _chat_request(text),
+        }, ensure_ascii=False)
+        for custom_id, text in texts_by_id.items()
+    ).encode()
+    batch_file = await _upload_batch_file(payload)
+    batch = await _create_batch(batch_file.id)
+    translation_cache.execute(
+        "INSERT INTO batches(id, texts) VALUES (?, ?)", (batch.id, json.dumps(texts_by_id, ensure_ascii=False)),
+    )
+    translation_cache.commit()
+    print(f"📦 Submitted OpenAI batch {batch.id} with {len(texts_by_id)} request(s)")
+    translations = await _finish_batch(batch.id, texts_by_id)
+
+    missing = [custom_id for custom_id in texts_by_id if custom_id not in translations]
+    if missing:
+        print(f"⚠️ {len(missing)} request(s) failed in the batch, translating them directly")
+        retried = await _translate_all([texts_by_id[custom_id] for custom_id in missing])
+        translations.update(zip(missing, retried))
+    return translations
+
+# === Google OCR ===
+OCR_BATCH_SIZE = 16
+# Vision also caps a request's total payload (~10 MB), so leave headroom.
+OCR_BATCH_MAX_BYTES = 8 * 1024 * 1024
+OCR_TIMEOUT = 120
+_ARABIC_CHAR_RE = re.compile(r'[\u0600-\u06FF]')
+# google.rpc codes worth retrying per image: DEADLINE_EXCEEDED, RESOURCE_EXHAUSTED, INTERNAL, UNAVAILABLE.
+OCR_RETRY_CODES = {4, 8, 13, 14}
+_vision_client = None
+
+class _OCRImagesPending(Exception):
+    pass
+
+def _get_vision_client():
+    global _vision_client
+    _vision_client = _vision_client or vision.ImageAnnotatorClient()
+    return _vision_client
+
+def _annotate(requests):
+    return _get_vision_client().batch_annotate_images(requests=requests, retry=None, timeout=OCR_TIMEOUT)
+
+def _read_bytes(image_path):
+    with io.open(image_path, "rb") as image_file:
+        return image_file.read()
+
+def _document_request(image):
+    return vision.AnnotateImageRequest(
+        image=image,
+        features=[vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION)],
+    )
+
+def _annotate_documents(images):
+    # Each image carries its own error, so one bad page must not cost the others their
+    # results: transient ones are retried alone, the rest come back as None.
+    results = [None] * len(images)
+    pending = list(range(len(images)))
+
+    @retry_transient
+    def annotate_pending():
+        response = _annotate([_document_request(images[i]) for i in pending])
+        retry_later = []
+        for i, image_response in zip(pending, response.responses):
+            error = image_response.error
+            if error.code in OCR_RETRY_CODES:
+                retry_later.append(i)
+            elif error.code or error.message:
+                print(f"⚠️ Google OCR error: {error.message}")
+            else:
+                results[i] = _sentence_boxes(image_response)
+        pending[:] = retry_later
+        if pending:
+            raise _OCRImagesPending(f"{len(pending)} image(s) hit a transient OCR error")
+
+    try:
+        annotate_pending()
+    except _OCRImagesPending as e:
+        print(f"⚠️ Google OCR gave up: {e}")
+    return results
+
+def google_ocr_batch_from_bytes(buffers):
+    return _annotate_documents([vision.Image(content=content) for content in buffers])
+
+def google_ocr_batch_from_uris(image_uris):
+    return _annotate_documents([
+        vision.Image(source=vision.ImageSource(image_uri=image_uri)) for image_uri in image_uris
+    ])
+
+def google_ocr_from_bytes(content):
+    return google_ocr_batch_from_bytes([content])[0]
+
+def google_ocr_batch(image_paths):
+    return google_ocr_batch_from_bytes([_read_bytes(image_path) for image_path in image_paths])
+
+def google_ocr(image_path):
+    return google_ocr_from_bytes(_read_bytes(image_path))
+
+def _worth_translating(text):
+    # Boxes failing this are left on the page untouched, so only skip text that needs
+    # no translation: no Latin letters at all (punctuation, digits) or already Arabic.
+    # Single letters and split contractions ("I", "A", "I ' M") are real dialogue.
+    if not _LATIN_RE.search(text):
+        return False
+    chars = len(text.replace(" ", ""))
+    return len(_ARABIC_CHAR_RE.findall(text)) * 2 < chars
+
+def _sentence_boxes(response):
+    sentence_boxes = []
+
+    for page in response.full_text_annotation.pages:
+        for block in page.blocks:
+            for paragraph in block.paragraphs:
+                sentence_text = ""
+                xmin = ymin = 10 ** 9
+                xmax = ymax = -1
+
+                for word in paragraph.words:
+                    word_text = ''.join([symbol.text for symbol in word.symbols])
+                    sentence_text += word_text + " "
+                    for vertex in word.bounding_box.vertices:
+                        x, y = vertex.x, vertex.y
+                        if x < xmin:
+                            xmin = x
+                        if x > xmax:
+                            xmax = x
+                        if y < ymin:
+                            ymin = y
+                        if y > ymax:
+                            ymax = y
+
+                if xmax < 0:
+                    continue
+                clean_text = sentence_text.strip()
+                area = (xmax - xmin) * (ymax - ymin)
+                if len(clean_text) <= 6 and area > 40000:
+                    continue
+                if not _worth_translating(clean_text):
+                    continue
+                bbox = [xmin, ymin, xmax, ymax]
+                sentence_boxes.append({"text": clean_text, "bbox": bbox})
+
+    return sentence_boxes
+
+# === Fonts & Shaping ===
+FONT_PATH = os.path.join(BASE_DIR, "Noto_Naskh_Arabic", "NotoNaskhArabic-VariableFont_wght.ttf")
+MAX_FONT_SIZE = 23
+MIN_FONT_SIZE = 18
+
+@functools.lru_cache(maxsize=None)
+def _font(size):
+    try:
+        return ImageFont.truetype(FONT_PATH, size)
+    except OSError:
+        return ImageFont.load_default()
+
+LINE_HEIGHTS = {size: _font(size).getbbox("Test")[3] for size in range(MIN_FONT_SIZE, MAX_FONT_SIZE + 1)}
+
+@functools.lru_cache(maxsize=4096)
+def _shape(line):
+    return get_display(arabic_reshaper.reshape(line))
+
+def shape_lines(lines):
+    # Shaping is ~0.1 ms per line, so a whole page costs a few ms; a process pool's
+    # dispatch alone costs as much, so pages are shaped inline.
+    unique_lines = list(dict.fromkeys(lines))
+    shaped_by_line = {line: _shape(line) for line in unique_lines}
+    return [shaped_by_line[line] for line in lines]
+
+# === Wrap Arabic Text ===
+def wrap_text(text, font, max_width):
+    space_width = font.getlength(" ")
+    lines = []
+    current_line = []
+    current_width = 0
+    for word in text.split():
+        word_width = font.getlength(word)
+        width = word_width if not current_line else current_width + space_width + word_width
+        if width <= max_width:
+            current_line.append(word)
+            current_width = width
+        else:
+            if current_line:
+                lines.append(" ".join(current_line))
+            current_line = [word]
+            current_width = word_width
+    if current_line:
+        lines.append(" ".join(current_line))
+    return lines
+
+def _wrap_at(text, font_size, max_width):
+    wrapped_lines = wrap_text(text, _font(font_size), max_width)
+    total_height = LINE_HEIGHTS[font_size] * len(wrapped_lines) + (len(wrapped_lines) - 1) * 4
+    return wrapped_lines, total_height
+
+def fit_text(text, max_width, max_height):
+    layouts = {}
+
+    def layout(font_size):
+        if font_size not in layouts:
+            layouts[font_size] = _wrap_at(text, font_size, max_width)
+        return layouts[font_size]
+
+    lo, hi = MIN_FONT_SIZE, MAX_FONT_SIZE
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if layout(mid)[1] <= max_height:
+            lo = mid
+        else:
+            hi = mid - 1
+    wrapped_lines, total_height = layout(lo)
+    return lo, wrapped_lines, total_height
+
+@dataclass
+class BubbleLayout:
+    font: ImageFont.FreeTypeFont
+    lines: list
+    widths: list
+    line_height: int
+    total_height: int
+
+def layout_bubbles(bubbles):
+    fits = [fit_text(text, max_width, max_height) for text, max_width, max_height in bubbles]
+    shaped = iter(shape_lines([line for _, wrapped_lines, _ in fits for line in wrapped_lines]))
+    layouts = []
+    for font_size, wrapped_lines, total_height in fits:
+        font = _font(font_size)
+        lines = [next(shaped) for _ in wrapped_lines]
+        widths = [round(font.getlength(line)) for line in lines]
+        layouts.append(BubbleLayout(font, lines, widths, LINE_HEIGHTS[font_size], total_height))
+    return layouts
+
+# === Erase & Draw Text ===
+PADDING_X, PADDING_Y = 12, 10
+SAVE_OPTIONS = {
+    "PNG": {"compress_level": 1, "optimize": False},
+    "JPEG": {"quality": 90, "subsampling": 2, "progressive": True},
+    "WEBP": {"method": 0, "quality": 85},
+}
+OUTPUT_EXTENSIONS = {"png": ".png", "jpeg": ".jpg", "webp": ".webp"}
+
+def save_image(image, output_path):
+    image_format = Image.registered_extensions().get(os.path.splitext(output_path)[1].lower(), "PNG")
+    image.save(output_path, format=image_format, **SAVE_OPTIONS.get(image_format, {}))
+
+def erase_sentences_from_image(image_path, sentence_boxes, output_path):
+    erase_sentences_from_bytes(_read_bytes(image_path), sentence_boxes, output_path)
+
+def erase_sentences_from_bytes(content, sentence_boxes, output_path):
+    pending = _translatable_boxes(sentence_boxes)
+    translations = translate_texts([text for _, text in pending])
+    render_translations(content, sentence_boxes, pending, translations, output_path)
+
+def _translatable_boxes(sentence_boxes):
+    pending = []
+    for box in sentence_boxes:
+        text = box["text"].strip()
+        if not text or text.isspace():
+            continue
+
+        x0, y0, x1, y1 = box["bbox"]
+        x0 = max(0, x0 - PADDING_X)
+        y0 = max(0, y0 - PADDING_Y)
+        x1 += PADDING_X
+        y1 += PADDING_Y
+        max_width = x1 - x0
+        max_height = y1 - y0
+        if max_width < 10 or max_height < 10:
+            continue
+        pending.append(((x0, y0, max_width, max_height), text))
+    return pending
+
+def render_translations(content, sentence_boxes, pending, translations, output_path):
+    image = Image.open(io.BytesIO(content)).convert("RGB")
+
+    pixels = np.asarray(image).copy()
+    for box in sentence_boxes:
+        x0, y0, x1, y1 = box["bbox"]
+        x0 = max(0, x0 - PADDING_X)
+        y0 = max(0, y0 - PADDING_Y)
+        x1 += PADDING_X
+        y1 += PADDING_Y
+        pixels[y0:y1 + 1, x0:x1 + 1] = 255
+    image = Image.fromarray(pixels)
+    draw = ImageDraw.Draw(image)
+
+    bubbles = []
+    for ((x0, y0, max_width, max_height), _), translated_text in zip(pending, translations):
+        if not _usable_translation(translated_text):
+            print(f"Skipping invalid translation: {translated_text}")
+            continue
+        translated_text = _LATIN_RE.sub('', translated_text).strip()
+        bubbles.append(((x0, y0, max_width, max_height), translated_text))
+
+    layouts = layout_bubbles([(text, max_width, max_height) for (_, _, max_width, max_height), text in bubbles])
+    for ((x0, y0, max_width, max_height), _), layout in zip(bubbles, layouts):
+        current_y = y0 + ((max_height - layout.total_height) // 2)
+        for line, line_width in zip(layout.lines, layout.widths):
+            center_x = x0 + ((max_width - line_width) // 2)
+            draw.text((center_x, current_y), line, fill="black", font=layout.font)
+            current_y += layout.line_height + 4
+
+    save_image(image, output_path)
+    print(f"✅ Translated and saved: {output_path}")
+
+# === Batch Processor ===
+def _list_gcs_images(folder_uri, supported_exts):
+    from google.cloud import storage
+
+    bucket_name, _, prefix = folder_uri[len("gs://"):].partition("/")
+    if prefix and not prefix.endswith("/"):
+        prefix += "/"
+    blobs = storage.Client().list_blobs(bucket_name, prefix=prefix, delimiter="/")
+    return [
+        (os.path.basename(blob.name), blob) for blob in blobs
+        if any(blob.name.lower().endswith(ext) for ext in supported_exts)
+    ]
+
+def _ocr_chunks(jobs):
+    chunk, chunk_bytes = [], 0
+    for job in jobs:
+        source = job[1]
+        # gs:// sources are read by Vision itself, so only local uploads count toward the budget.
+        size = os.path.getsize(source) if isinstance(source, str) else 0
+        if chunk and (len(chunk) == OCR_BATCH_SIZE or chunk_bytes + size > OCR_BATCH_MAX_BYTES):
+            yield chunk
+            chunk, chunk_bytes = [], 0
+        chunk.append(job)
+        chunk_bytes += size
+    if chunk:
+        yield chunk
+
+def _ocr_chunk(sources):
+    if sources and not isinstance(sources[0], str):
+        # Vision reads straight from GCS; pages are downloaded only when drawn.
+        return sources, google_ocr_batch_from_uris([f"gs://{blob.bucket.name}/{blob.name}" for blob in sources])
+    contents = [_read_bytes(input_path) for input_path in sources]
+    return contents, google_ocr_batch_from_bytes(contents)
+
+def _load_source(source):
+    if isinstance(source, bytes):
+        return source
+    if isinstance(source, str):
+        return _read_bytes(source)
+    return source.download_as_bytes()
+
+def _draw_one(filename, source, sentences, pending, translations, output_path):
+    print(f"🔄 Processing: {filename}")
+    content = _load_source(source)
+    render_translations(content, sentences, pending, translations, output_path)
+
+async def _run_pipeline(jobs):
+    loop = asyncio.get_running_loop()
+    ocr_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    draw_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+
+    async def ocr_stage():
+        for chunk in _ocr_chunks(jobs):
+            print(f"🔍 Running OCR on {len(chunk)} image(s)")
+            contents, results = await loop.run_in_executor(None, _ocr_chunk, [source for _, source, _ in chunk])
+            for (filename, _, output_path), content, sentences in zip(chunk, contents, results):
+                if sentences is None:
+                    print(f"⚠️ Skipping {filename}: OCR failed")
+                    continue
+                await ocr_queue.put((filename, content, sentences, output_path))
+        for _ in range(PAGE_WORKERS):
+            await ocr_queue.put(None)
+
+    async def translate_worker():
+        while (page := await ocr_queue.get()) is not None:
+            filename, content, sentences, output_path = page
+            pending = _translatable_boxes(sentences)
+            translations = await _translate_all([text for _, text in pending])
+            await draw_queue.put((filename, content, sentences, pending, translations, output_path))
+
+    async def translate_stage():
+        await asyncio.gather(*(translate_worker() for _ in range(PAGE_WORKERS)))
+        for _ in range(PAGE_WORKERS):
+            await draw_queue.put(None)
+
+    async def draw_worker():
+        while (page := await draw_queue.get()) is not None:
+            await loop.run_in_executor(None, _draw_one, *page)
+
+    tasks = [
+        asyncio.ensure_future(ocr_stage()),
+        asyncio.ensure_future(translate_stage()),
+        *(asyncio.ensure_future(draw_worker()) for _ in range(PAGE_WORKERS)),
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+def _process_folder_batch(jobs):
+    # Collect finished batches left over from an interrupted run before paying for OCR;
+    # ones still running are only waited on if this run needs their texts.
+    running_batches = asyncio.run_coroutine_threadsafe(harvest_batches(), _translate_loop).result()
+
+    # Keep only paths/blobs between the two phases; pages are re-read when drawn.
+    pages = []
+    for chunk in _ocr_chunks(jobs):
+        print(f"🔍 Running OCR on {len(chunk)} image(s)")
+        _, results = _ocr_chunk([source for _, source, _ in chunk])
+        for (filename, source, output_path), sentences in zip(chunk, results):
+            if sentences is None:
+                print(f"⚠️ Skipping {filename}: OCR failed")
+                continue
+            pages.append((filename, source, sentences, _translatable_boxes(sentences), output_path))
+
+    translation_by_text = {}
+    uncached = {}
+    seen = set()
+    for _, _, _, pending, _ in pages:
+        for _, text in pending:
+            if text in seen:
+                continue
+            seen.add(text)
+            cached = _cached_translation(text)
+            if cached is not None:
+                translation_by_text[text] = cached
+            else:
+                uncached[f"text_{len(uncached)}"] = text
+
+    needed = set(uncached.values())
+    overlapping = {
+        batch_id: texts_by_id for batch_id, texts_by_id in running_batches.items()
+        if needed & set(texts_by_id.values())
+    }
+    if overlapping:
+        asyncio.run_coroutine_threadsafe(wait_for_batches(overlapping), _translate_loop).result()
+        for custom_id, text in list(uncached.items()):
+            cached = _cached_translation(text)
+            if cached is not None:
+                translation_by_text[text] = cached
+                del uncached[custom_id]
+    print(f"🧮 {len(seen)} unique text(s), {len(uncached)} not cached")
+    if uncached:
+        translations = asyncio.run_coroutine_threadsafe(translate_batch(uncached), _translate_loop).result()
+        translation_by_text.update((uncached[custom_id], translated_text) for custom_id, translated_text in translations.items())
+
+    with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as executor:
+        futures = [
+            executor.submit(
+                _draw_one, filename, source, sentences, pending,
+                [translation_by_text[text] for _, text in pending], output_path,
+            )
+            for filename, source, sentences, pending, output_path in pages
+        ]
+        for future in futures:
+            future.result()
+
+def process_folder(folder_path, output_folder, output_format=None, interactive=False):
+    supported_exts = [".jpg", ".jpeg", ".png", ".webp"]
+    os.makedirs(output_folder, exist_ok=True)
+
+    if folder_path.startswith("gs://"):
+        images = _list_gcs_images(folder_path, supported_exts)
+    else:
+        images = [
+            (filename, os.path.join(folder_path, filename)) for filename in os.listdir(folder_path)
+            if any(filename.lower().endswith(ext) for ext in supported_exts)
+        ]
+
+    jobs = []
+    for filename, source in images:
+        output_name = filename
+        if output_format:
+            # Keep the source extension so a.jpg and a.png don't both become a.png.
+            output_name = filename + OUTPUT_EXTENSIONS[output_format]
+        jobs.append((filename, source, os.path.join(output_folder, f"translated_{output_name}")))
+
+    if interactive:
+        asyncio.run_coroutine_threadsafe(_run_pipeline(jobs), _translate_loop).result()
+    else:
+        _process_folder_batch(jobs)
+
+# === Run ===
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Translate manga pages into Palestinian Arabic.")
+    parser.add_argument(
+        "input_folder", nargs="?", default=os.path.join(BASE_DIR, "images"),
+        help="local folder or gs://bucket/prefix to read pages from (default: images/)",
+    )
+    parser.add_argument(
+        "output_folder", nargs="?", default=os.path.join(BASE_DIR, "output"),
+        help="local folder to write translated pages to (default: output/)",
+    )
+    parser.add_argument(
+        "--format", choices=sorted(OUTPUT_EXTENSIONS),
+        help="encode translated pages in this format instead of the input's",
+    )
+    parser.add_argument(
+        "--interactive", action="store_true",
+        help="translate in real time instead of through the OpenAI Batch API",
+    )
+    args = parser.parse_args()
+
+    process_folder(args.input_folder, args.output_folder, output_format=args.format, interactive=args.interactive)